@@ -0,0 +1,7 @@
+#!/bin/sh
+# Precompile setup.py into __pycache__
+#  so yubikey-setup launcher skips parsing on first run too
+# Python revalidates cached bytecode by its version and source mtime
+set -e
+cd "$(dirname "$0")"
+python3 -m compileall -q setup.py
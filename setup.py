@@ -1,18 +1,27 @@
-import tarfile
-import gzip
-import json
 import os
-import platform
 import shutil
-import secrets
+import tempfile
+import shlex
+import sys
 from contextlib import contextmanager
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import Popen, PIPE, DEVNULL
+from collections import namedtuple
 from functools import lru_cache, cmp_to_key, reduce
 
 
 SCRIPT_NAME = "YUBIKEY_SETUP"
 
-TMP_DIR = os.path.join("/tmp", f"{SCRIPT_NAME}_{secrets.token_urlsafe(10)}")
+# Created by tmp_dir() context manager
+TMP_DIR = None
+# Replaced with actual TMP_DIR in commands right before execution
+TMP_DIR_PLACEHOLDER = "{TMP_DIR}"
+
+CACHE_DIR = os.path.join(os.path.expanduser("~/.cache"), SCRIPT_NAME.lower())
+YKMAN_CMD_CACHE = os.path.join(CACHE_DIR, "ykman_cmd")
+
+# Max files per shred invocation (keeps argv far below ARG_MAX)
+SHRED_BATCH = 256
 
 SUPPORTED_OS       = "linux".split(" ")
 RECOMENDED_DISTROS = "tails".split(" ")
@@ -23,16 +32,44 @@ CL_GREEN  = "\033[92m"
 CL_RED    = "\033[91m"
 CL_GREY   = "\033[90m"
 
+APT_INSTALL = ("sudo", "apt", "-qq", "install", "-y")
+# Value-less flags already covered by APT_INSTALL
+# apt installs with any other options are not merged
+APT_MERGEABLE_FLAGS = frozenset(("-q", "-qq", "--quiet", "-y", "--yes", "--assume-yes"))
+
+# Group of independent commands that may be executed concurrently
+# Executed serially if any of them needs sudo (to not mix password prompts)
+# Output is captured so msg (if any) is printed before start
+#  to show that something is going on
+Parallel = namedtuple("Parallel", "cmds msg", defaults=(None,))
+# Command that is skipped if check command succeeds
+Unless = namedtuple("Unless", "check cmd")
+
+GPG_RECV_KEY = ("gpg", "--quiet", "--keyserver", "hkps://keys.openpgp.org", "--receive-keys")
+# Fetch key only if it is not in keyring yet
+def gpg_recv_key(fpr):
+    return Unless(("gpg", "--list-keys", fpr), GPG_RECV_KEY + (fpr,))
+
+WGET = ("torsocks", "wget", "-c", "-t", "0", "--retry-connrefused", "--quiet")
+YKMAN_URL = "https://developers.yubico.com/yubikey-manager-qt/Releases/yubikey-manager-qt-latest-linux.AppImage"
+YKMAN_TMP_DIR = f"{TMP_DIR_PLACEHOLDER}/ykman"
+YKMAN_TMP = f"{YKMAN_TMP_DIR}/yubikey-manager-qt.AppImage"
+
 PKGS_NAME          = "Package name"
 PKGS_COMMENT       = "Package comment"
+# <cmd> or (<cmd>, <required status code>), 0 by default
 PKGS_CHECK         = "Availability check cmd"
 PKGS_TAILS_INSTALL = "Tails intalation commands"
 PKGS_ISNTALL       = "Instalation commands"
+# Optional per distro cmd. If it succeeds pkg files are already in place
+#  so instalation commands are skipped (availability check still decides
+#  whether pkg is usable)
+PKGS_PRECHECK      = "Instalation precheck cmd"
 PKGS = (
     {
         PKGS_NAME: "gnupg",
         PKGS_COMMENT: "GNU Privacy Guard",
-        PKGS_CHECK: "gpg --version",
+        PKGS_CHECK: ("gpg", "--version"),
         PKGS_ISNTALL: {
             # Should be already installed in Tails
         },
@@ -40,48 +77,94 @@ PKGS = (
     {
         PKGS_NAME: "argon2",
         PKGS_COMMENT: "memory & CPU hard hash function",
-        PKGS_CHECK: ("argon2 -h", 1),
+        PKGS_CHECK: (("argon2", "-h"), 1),
         PKGS_ISNTALL: {
-            "tails": "sudo apt -qq install -y argon2",
+            "tails": (APT_INSTALL + ("argon2",),),
         },
     },
     {
         PKGS_NAME: "ykman",
         PKGS_COMMENT: "yubikey cli & gui manager",
-        PKGS_CHECK: "ykman --help",
+        PKGS_CHECK: ("ykman", "--help"),
+        PKGS_PRECHECK: {
+            # Image was installed by this script earlier
+            "tails": ("gpg", "--quiet", "--verify", "/bin/ykman.sig", "/bin/ykman"),
+        },
         PKGS_ISNTALL: {
             "tails": (
-                "# Adding yubico maintaners GPG keys",
-                "gpg --quiet --keyserver hkps://keys.openpgp.org --receive-keys 9E885C0302F9BB9167529C2D5CBA11E6ADC7BCD1",
-                "gpg --quiet --keyserver hkps://keys.openpgp.org --receive-keys 57a9deed4c6d962a923bb691816f3ed99921835e",
-                
-                "# Download ykman AppImage",
-                f"mkdir -p {TMP_DIR}/ykman",
-                f"torsocks wget -c -t 0 --retry-connrefused --quiet --show-progress -O {TMP_DIR}/ykman/yubikey-manager-qt.AppImage https://developers.yubico.com/yubikey-manager-qt/Releases/yubikey-manager-qt-latest-linux.AppImage",
-                f"torsocks wget -c -t 0 --retry-connrefused --quiet --show-progress -O {TMP_DIR}/ykman/yubikey-manager-qt.AppImage.sig https://developers.yubico.com/yubikey-manager-qt/Releases/yubikey-manager-qt-latest-linux.AppImage.sig",
-                
+                ("mkdir", "-p", YKMAN_TMP_DIR),
+
+                "# Adding yubico maintaners GPG keys & download ykman AppImage",
+                Parallel((
+                    gpg_recv_key("9E885C0302F9BB9167529C2D5CBA11E6ADC7BCD1"),
+                    gpg_recv_key("57a9deed4c6d962a923bb691816f3ed99921835e"),
+                    WGET + ("-O", YKMAN_TMP, YKMAN_URL),
+                    WGET + ("-O", YKMAN_TMP + ".sig", YKMAN_URL + ".sig"),
+                ), msg="Fetching GPG keys & downloading ykman AppImage (may take a while over Tor)..."),
+
                 "# Verify downloaded image",
-                f"gpg --quiet --verify {TMP_DIR}/ykman/yubikey-manager-qt.AppImage.sig",
+                ("gpg", "--quiet", "--verify", YKMAN_TMP + ".sig"),
 
                 "# Make image executable",
-                f"chmod +x {TMP_DIR}/ykman/yubikey-manager-qt.AppImage",
+                ("chmod", "+x", YKMAN_TMP),
 
                 "# Move image to /bin",
-                f"sudo mv {TMP_DIR}/ykman/yubikey-manager-qt.AppImage /bin/ykman",
+                ("sudo", "mv", YKMAN_TMP, "/bin/ykman"),
+
+                "# Keep signature for next runs checks",
+                ("sudo", "mv", YKMAN_TMP + ".sig", "/bin/ykman.sig"),
             ),
         },
     },
 )
 
+# Split PKGS_CHECK value into (<cmd>, <required status code>)
+def split_check(check):
+    if not isinstance(check, str) and len(check) == 2 and isinstance(check[1], int):
+        return check
+    return check, 0
+
+# PKGS with check command/code normalized into attributes
+# summary is colored line for dependencies listing
+Pkg = namedtuple("Pkg", "name comment check_cmd check_code install precheck summary")
+PKGS_NORMALIZED = tuple(
+    Pkg(
+        name=pkg[PKGS_NAME],
+        comment=pkg[PKGS_COMMENT],
+        check_cmd=split_check(pkg[PKGS_CHECK])[0],
+        check_code=split_check(pkg[PKGS_CHECK])[1],
+        install=pkg[PKGS_ISNTALL],
+        precheck=pkg.get(PKGS_PRECHECK, {}),
+        summary=f"\t{CL_GREEN}{pkg[PKGS_NAME]}{CL_NORM} ({pkg[PKGS_COMMENT]})",
+    ) for pkg in PKGS
+)
+# <distro>: <pkgs that can be installed automatically there>
+PKGS_BY_DISTRO = {
+    distro: [pkg for pkg in PKGS_NORMALIZED if distro in pkg.install]
+    for distro in {distro for pkg in PKGS_NORMALIZED for distro in pkg.install}
+}
+
+# Single sh script that succeeds only if all PKGS_NORMALIZED are available
+# Lets check_deps to skip per pkg probes in common case
+PKGS_CHECK_ALL = ("sh", "-c", " && ".join(
+    f"{{ {{ {pkg.check_cmd if isinstance(pkg.check_cmd, str) else shlex.join(pkg.check_cmd)}; }} >/dev/null 2>&1; [ $? = {pkg.check_code} ]; }}"
+    for pkg in PKGS_NORMALIZED
+))
+
 PRE_INSTALL = {
     "tails": "sudo apt -q update -y "
 }
-# Singleton
-PRE_INSTALL_RUNNED = False
 
 YES = "Yes"
 NO = "No"
 YES_OR_NO = f"'{CL_GREEN}{YES}{CL_NORM}' or '{CL_RED}{NO}{CL_NORM}'"
+ASK_SUFFIX = f" ({YES_OR_NO}): "
+ASK_RETRY_MSG = f"\t{CL_YELLOW}Please type {YES_OR_NO}"
+CONTINUE_PROMPT = f"Press {CL_GREEN}Enter{CL_NORM} when you are ready: "
+
+# Commands listing formatting
+SUDO_PREFIX = f"\t{CL_YELLOW}sudo{CL_NORM} "
+COMMENT_TPL = f"\t{CL_GREY}%s{CL_NORM}\n"
 
 WRONG_OS_MSG = f"{CL_RED}Srry, your os is not currently supported by script{CL_NORM}"
 RECOMMEND_OS_MSG = f"{CL_YELLOW}It is strongly recommended to use hardened OS distros to work with this script.\nSuch as {' or '.join(RECOMENDED_DISTROS)}.{CL_NORM}"
@@ -104,16 +187,17 @@ BEGIN_MSG = """
 """
 
 def ask_continue():
-    input(f"Press {CL_GREEN}Enter{CL_NORM} when you are ready: ")
+    input(CONTINUE_PROMPT)
 
 def ask(prompt):
+    prompt += ASK_SUFFIX
     while True:
-        inp = input(prompt+f" ({YES_OR_NO}): ")
+        inp = input(prompt)
         if inp == YES:
             return True
         if inp == NO:
             return False
-        print(f"\t{CL_YELLOW}Please type {YES_OR_NO}")
+        print(ASK_RETRY_MSG)
 
 def ask_execute(cmds):
     if cmds is None:
@@ -121,14 +205,15 @@ def ask_execute(cmds):
     if isinstance(cmds, str):
         cmds = (cmds,)
     prompt = "Those commands will be executed:\n"
-    for cmd in cmds:
-        if cmd.lstrip().startswith("#"):
-            prompt += f"\t{CL_GREY}{cmd}{CL_NORM}\n"
+    for cmd in flat_cmds(cmds):
+        stripped = cmd.lstrip()
+        if stripped.startswith("#"):
+            prompt += COMMENT_TPL % cmd
             continue
-        if cmd.lstrip().startswith("sudo "):
-            prompt += f"\t{CL_YELLOW}sudo{CL_NORM} {cmd.replace('sudo ', '', 1)}\n"
+        if stripped.startswith("sudo "):
+            prompt += SUDO_PREFIX + stripped[5:] + "\n"
             continue
-        prompt += f"\t{cmd}\n"
+        prompt += "\t" + cmd + "\n"
     prompt += "\nDo you want to execute them?"
     return ask(prompt)
 
@@ -138,34 +223,59 @@ def ask_execute(cmds):
 # ("win", "10")
 @lru_cache(maxsize=None)
 def get_os_info():
-    system = platform.system().lower()
-    version = platform.version()
-    if system == "linux":
-        if "Debian" in version:
-            if os.path.isdir('/etc/tails') and os.path.isdir('/etc/amnesia') and os.getlogin() == "amnesia":
-                return "linux", "tails"
-        version = version.split("-")
-        if len(version) < 2:
-            return system, version[0]
-        version = version[1].split(" ")[0]
-    version = version.lower()
-    return system, version
+    # os.uname is not available on windows
+    system = os.uname().sysname.lower() if hasattr(os, "uname") else sys.platform
+    if system != "linux":
+        return system, None
+    # Tails sets ID=tails so no extra checks required
+    return system, read_os_release().get("ID", "").lower() or None
+
+# Parse /etc/os-release into dict
+# Empty dict if there is no such file
+def read_os_release():
+    release = {}
+    try:
+        with open("/etc/os-release") as f:
+            for line in f:
+                if "=" not in line or line.startswith("#"):
+                    continue
+                key, value = line.rstrip().split("=", 1)
+                release[key] = value.strip("\"'")
+    except OSError:
+        pass
+    return release
 
 # (<status code>, <stdout if not interactive>, <sterr if not interactive>)
-def run_cmd(cmd, interactive=True):
+# If quiet output is discarded without allocating pipes
+#  and empty strings are returned
+# cmd is executed without shell
+#  it may be string (splitted with shlex) or already splitted list
+# Codes for not found/not executable programs are the same as in sh
+def run_cmd(cmd, interactive=True, quiet=False):
     if cmd is None:
         return 0, "", ""
-    #cmd = shlex.split(cmd)
-    out, err = "", ""
-    stdout, stderr = None, None
-    if not interactive:
-        stdout, stderr = PIPE, PIPE
-    with Popen(cmd, shell=True, stdout=stdout, stderr=stderr) as proc:
-        code = proc.wait()
-        if not interactive:
-            out = proc.stdout.read()
-            err = proc.stderr.read()
-        return code, out, err
+    if isinstance(cmd, str):
+        cmd = shlex.split(cmd)
+    stdin, stdout, stderr = None, None, None
+    if quiet:
+        interactive = True # Nothing to capture
+        stdin, stdout, stderr = DEVNULL, DEVNULL, DEVNULL
+    elif not interactive:
+        stdin, stdout, stderr = DEVNULL, PIPE, PIPE
+    empty = "" if interactive else b""
+    try:
+        proc = Popen(cmd, stdin=stdin, stdout=stdout, stderr=stderr)
+    except FileNotFoundError:
+        return 127, empty, empty
+    except PermissionError:
+        return 126, empty, empty
+    with proc:
+        # communicate drains both pipes while waiting
+        #  so child can't block on full pipe buffer
+        out, err = proc.communicate()
+        if interactive:
+            out, err = "", ""
+        return proc.returncode, out, err
 
 # returns status code
 # 0 if all commands return 0
@@ -175,34 +285,129 @@ def run_cmds(cmds, interactive=True):
     if isinstance(cmds, str):
         cmds = (cmds,)
     for cmd in cmds:
-        if cmd.strip().startswith("#"):
+        if isinstance(cmd, Parallel):
+            code = run_parallel(cmd)
+        elif isinstance(cmd, str) and cmd.strip().startswith("#"):
             continue
-        code, _, _ = run_cmd(cmd, interactive)
+        else:
+            code, _, _ = run_cond_cmd(cmd, interactive)
+        if code != 0:
+            return code
+    return 0
+
+# Run Parallel group
+# returns first non zero status code or 0
+def run_parallel(group):
+    if any(cmd.lstrip().startswith("sudo ") for cmd in flat_cmds(group.cmds)):
+        return run_cmds(group.cmds)
+    if group.msg is not None:
+        print(group.msg, flush=True)
+    with ThreadPoolExecutor(max_workers=len(group.cmds)) as ex:
+        results = list(ex.map(lambda cmd: run_cond_cmd(cmd, False), group.cmds))
+    for cmd, (code, _, err) in zip(flat_cmds(group.cmds), results):
         if code != 0:
+            print(f"{CL_RED}Failed{CL_NORM}: {cmd}")
+            print(err.decode(errors="replace"), end="")
             return code
     return 0
 
+# run_cmd that also accepts Unless commands
+def run_cond_cmd(cmd, interactive=True):
+    if isinstance(cmd, Unless):
+        if run_cmd(cmd.check, quiet=True)[0] == 0:
+            return 0, "" if interactive else b"", "" if interactive else b""
+        cmd = cmd.cmd
+    return run_cmd(cmd, interactive)
+
+# Substitute TMP_DIR_PLACEHOLDER with current TMP_DIR
+def expand_tmp_dir(cmd):
+    if isinstance(cmd, Parallel):
+        return cmd._replace(cmds=tuple(map(expand_tmp_dir, cmd.cmds)))
+    if isinstance(cmd, Unless):
+        return Unless(expand_tmp_dir(cmd.check), expand_tmp_dir(cmd.cmd))
+    if isinstance(cmd, str):
+        return cmd.replace(TMP_DIR_PLACEHOLDER, TMP_DIR)
+    return tuple(arg.replace(TMP_DIR_PLACEHOLDER, TMP_DIR) for arg in cmd)
+
+# Expand Parallel groups and Unless commands into plain commands list
+#  argv tuples are joined into strings
+# Parallel groups can't be nested
+def flat_cmds(cmds):
+    for cmd in cmds:
+        if isinstance(cmd, Parallel):
+            yield from flat_cmds(cmd.cmds)
+            continue
+        if isinstance(cmd, Unless):
+            cmd = cmd.cmd
+        yield cmd if isinstance(cmd, str) else shlex.join(cmd)
+
+# Yields ("file", path), ("link", path) and ("dir", path) pairs
+#  dirs are yielded after their content
+# Symlinks are not followed
+# Uses scandir d_type so no extra stat per entry required
+def walk_post(root):
+    # Unreadable dirs and raced entries are skipped
+    #  regular delete in fs_del will handle them
+    try:
+        stack = [(root, os.scandir(root))]
+    except OSError:
+        return
+    while stack:
+        path, it = stack[-1]
+        try:
+            entry = next(it, None)
+        except OSError:
+            entry = None
+        if entry is None:
+            it.close()
+            stack.pop()
+            yield "dir", path
+            continue
+        try:
+            if entry.is_dir(follow_symlinks=False):
+                stack.append((entry.path, os.scandir(entry.path)))
+                continue
+            kind = "link" if entry.is_symlink() else "file"
+        except OSError:
+            continue
+        yield kind, entry.path
+
 # Try to destroy file/dir using GNU Shred
 # If failed for some reason (for example shred does not exist),
 #   delete in the usual way.
 def fs_del(path):
-    if os.path.isdir(path):
-        # Dir
-        # Calls fs_del for all subentities
-        for root, dirs, files in os.walk(path):
-            for dr in dirs:
-                fs_del(os.path.join(root, dr))
-            for file in files:
-                fs_del(os.path.join(root, file))
+    files, dirs, links = [], [], []
+    if os.path.islink(path):
+        links.append(path)
+    elif os.path.isdir(path):
+        for kind, entry in walk_post(path):
+            {"file": files, "link": links, "dir": dirs}[kind].append(entry)
     else:
-        # File
-        # Try to shred
-        run_cmd(f"shred -f -u -z {path}", False)
-    # Regualr delete
-    try:
-        shutil.rmtree(path)
-    except FileNotFoundError:
-        pass # Already deleted
+        files.append(path)
+    # Shred would overwrite symlink target
+    for link in links:
+        try:
+            os.unlink(link)
+        except OSError:
+            pass
+    # Shred accepts multiple targets so one process per batch is enough
+    for i in range(0, len(files), SHRED_BATCH):
+        code, _, _ = run_cmd(["shred", "-f", "-u", "-z", *files[i:i+SHRED_BATCH]], quiet=True)
+        if code == 127:
+            break # No shred
+    for dr in dirs:
+        try:
+            os.rmdir(dr)
+        except OSError:
+            pass
+    # Regualr delete for anything left
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.lexists(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 # In depend of istalled ykman disribution
 #  there is may be two variants how to run it in cli:
@@ -213,65 +418,149 @@ def fs_del(path):
 #   $ ykman
 #   If there is ykman cli installed by itself
 # See https://github.com/Yubico/yubikey-manager-qt/pull/293
+# Probe result is cached in YKMAN_CMD_CACHE between runs
 @lru_cache(maxsize=None)
 def get_ykman_cmd():
-    if run_cmd("ykman ykman", False) == 0:
-        return "ykman ykman"
-    return "ykman"
+    path = shutil.which("ykman")
+    if path is None:
+        return "ykman" # Not installed yet, nothing to cache
+    # Cache is valid only for the same ykman binary
+    #  "<binary path> <mtime>\n<cmd>"
+    try:
+        key = f"{path} {os.stat(path).st_mtime_ns}"
+    except OSError:
+        return "ykman"
+    cached = read_cache(YKMAN_CMD_CACHE)
+    if cached is not None:
+        cached_key, _, cmd = cached.partition("\n")
+        if cached_key == key and cmd:
+            return cmd
+    cmd = "ykman"
+    if run_cmd("ykman ykman --help", quiet=True)[0] == 0:
+        cmd = "ykman ykman"
+    write_cache(YKMAN_CMD_CACHE, f"{key}\n{cmd}")
+    return cmd
+
+# Returns cached value or None
+def read_cache(path):
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+# Atomically replaces cache file content
+# Failures are ignored cause cache is optional
+def write_cache(path, value):
+    tmp = f"{path}.{os.getpid()}"
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            f.write(value)
+        os.replace(tmp, path)
+    except OSError:
+        pass
 
 def chek_can_install(deps, distro):
+    installable = PKGS_BY_DISTRO.get(distro, ())
     available, not_available = [], []
     for dep in deps:
-        if distro in dep[PKGS_ISNTALL]:
+        if dep in installable:
             available.append(dep)
         else:
             not_available.append(dep)
     return available, not_available
 
+# Cached so pre install is asked & executed only once
+@lru_cache(maxsize=None)
 def run_pre_install(distro):
-    global PRE_INSTALL_RUNNED
-    if PRE_INSTALL_RUNNED:
-        return True
-    PRE_INSTALL_RUNNED = True
     if distro not in PRE_INSTALL:
         return True # Nothing special shoud be done
     if not ask_execute(PRE_INSTALL[distro]):
         return False
     return run_cmds(PRE_INSTALL[distro]) == 0
 
+# Coalesce all "sudo apt install" commands into single one
+#  placed before other commands
+# Saves apt/dpkg startup per package
+def merge_apt_installs(commands):
+    apt_pkgs, other = [], []
+    for cmd in commands:
+        pkgs = apt_install_pkgs(cmd)
+        if pkgs is None:
+            other.append(cmd)
+            continue
+        apt_pkgs += pkgs
+    if len(apt_pkgs) == 0:
+        return other
+    return [APT_INSTALL + tuple(apt_pkgs)] + other
+
+# Returns pkgs list if cmd is "sudo apt [opts] install [opts] pkgs..."
+#  with only APT_MERGEABLE_FLAGS as opts
+# None otherwise (such command is executed as is)
+def apt_install_pkgs(cmd):
+    if isinstance(cmd, str):
+        if cmd.lstrip().startswith("#"):
+            return None
+        cmd = shlex.split(cmd)
+    elif isinstance(cmd, (Parallel, Unless)):
+        return None
+    if tuple(cmd[:2]) != ("sudo", "apt"):
+        return None
+    opts = [arg for arg in cmd[2:] if arg.startswith("-")]
+    if any(opt not in APT_MERGEABLE_FLAGS for opt in opts):
+        return None
+    args = [arg for arg in cmd[2:] if not arg.startswith("-")]
+    if len(args) < 2 or args[0] != "install":
+        return None
+    return args[1:]
+
 def install_deps(distro, deps):
     commands = []
+    broken = False
     for dep in deps:
-        cmd = dep[PKGS_ISNTALL][distro]
+        # deps are missing ones so if precheck passes
+        #  pkg is installed but does not work
+        if distro in dep.precheck and run_cmd(dep.precheck[distro], quiet=True)[0] == 0:
+            print(f"{CL_YELLOW}{dep.name}{CL_NORM} is already present but not runnable, {CL_RED}please fix it manually{CL_NORM}")
+            broken = True
+            continue
+        cmd = dep.install[distro]
         if isinstance(cmd, str):
             commands.append(cmd)
             continue
         commands += cmd
+    commands = [expand_tmp_dir(cmd) for cmd in merge_apt_installs(commands)]
+    if len(commands) == 0:
+        return not broken
     if not ask_execute(commands):
         return False
-    return run_cmds(commands) == 0
+    return run_cmds(commands) == 0 and not broken
+
+# Returns True if pkg is available
+def check_pkg(pkg):
+    code, _, _ = run_cmd(pkg.check_cmd, quiet=True)
+    return code == pkg.check_code
 
 def check_deps():
     _, distro = get_os_info()
     recheck = False
     while True:
-        to_install = []
-        for pkg in PKGS:
-            check_cmd, req_code = "", 0
-            if isinstance(pkg[PKGS_CHECK], str):
-                check_cmd = pkg[PKGS_CHECK]
-            else:
-                check_cmd = pkg[PKGS_CHECK][0]
-                req_code  = pkg[PKGS_CHECK][1]
-            code, _, _ = run_cmd(check_cmd, False)
-            if code != req_code:
-                to_install.append(pkg)
+        if run_cmd(PKGS_CHECK_ALL, quiet=True)[0] == 0:
+            return True
+        # Find out what exactly is missing
+        # Probes are independent so run them concurrently
+        #  map() keeps results in PKGS order
+        with ThreadPoolExecutor() as ex:
+            missing = ex.map(lambda pkg: not check_pkg(pkg), PKGS_NORMALIZED)
+            to_install = [pkg for pkg, miss in zip(PKGS_NORMALIZED, missing) if miss]
         if len(to_install) == 0:
             return True
         if not recheck:
             print("This script needs to instal those dependencies:")
             for pkg in to_install:
-                print(f"\t{CL_GREEN}{pkg[PKGS_NAME]}{CL_NORM} ({pkg[PKGS_COMMENT]})")
+                print(pkg.summary)
             print(f"Press {CL_GREY}Ctrl+c{CL_NORM} to skip packages management {CL_GREY}at your own risk{CL_NORM}")
         recheck = False
         auto, manual = chek_can_install(to_install, distro)
@@ -280,7 +569,7 @@ def check_deps():
             if len(auto) == 0:
                 print(f"They cannot be install automatically on current system")
             else:
-                prompt = f"{CL_YELLOW}{' '.join(map(lambda pkg: pkg[PKGS_NAME], manual))}{CL_NORM}"
+                prompt = f"{CL_YELLOW}{' '.join(map(lambda pkg: pkg.name, manual))}{CL_NORM}"
                 print(f"Those packages cannot be install automatically on current system:\n\t{prompt}")
             print("Please install them manually before continue")
             ask_continue()
@@ -299,6 +588,7 @@ def check_deps():
             print(f"\n{CL_RED}Failed to install script dependencies{CL_NORM}")
             return False
 
+@lru_cache(maxsize=None)
 def check_os():
     os, distro = get_os_info()
     if os not in SUPPORTED_OS:
@@ -336,11 +626,16 @@ def check_swaps():
 # Yes, I know about tempfile.TemporaryDirectory
 # I use custom analog cause I'm trying to destroy tmp files
 #  more securely (using GNU Shred if available) 
+# mkdtemp atomically creates dir with 0700 mode
 @contextmanager
 def tmp_dir():
-    os.makedirs(TMP_DIR, mode=0o700)
-    yield TMP_DIR
-    fs_del(TMP_DIR)
+    global TMP_DIR
+    TMP_DIR = tempfile.mkdtemp(prefix=f"{SCRIPT_NAME}_", dir="/tmp")
+    try:
+        yield TMP_DIR
+    finally:
+        fs_del(TMP_DIR)
+        TMP_DIR = None
 
 def init():
     if not check_os(): return False
@@ -358,10 +653,14 @@ def main():
     print(BEGIN_MSG)
     # TODO 
 
-if __name__ == "__main__":
+# Entry point, also used by yubikey-setup launcher
+def run():
     with tmp_dir():
         try:
             main()
         except KeyboardInterrupt:
             print(f"\n{CL_RED}Interrupted by user{CL_NORM}")
     print("\nBye")
+
+if __name__ == "__main__":
+    run()